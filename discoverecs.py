@@ -1,11 +1,24 @@
 from __future__ import print_function
-from collections import defaultdict
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
+from botocore.config import Config
 import boto3
 import json
 import argparse
+import hashlib
+import logging
 import time
 import os
 import re
+import sys
+import threading
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 """
 Copyright 2018, 2019, 2020 Signal Media Ltd
@@ -40,9 +53,16 @@ PROMETHEUS_PORT must be set when using awsvpc network mode. It can also be used
 for tasks using a classic ELB setup with multiple port mappings.
 """
 
+_INTERVALS = ("15s", "30s", "1m", "5m")
+_VALID_INTERVALS = frozenset(_INTERVALS)
+_INVALID_LABEL_CHARS_RE = re.compile(r"[^a-zA-Z0-9_]")
+_LEADING_DIGIT_RE = re.compile(r"^[0-9]")
+
+logger = logging.getLogger(__name__)
+
 
 def log(message):
-    print(message)
+    logger.info(message)
 
 
 def chunk_list(l, n):
@@ -56,45 +76,111 @@ def dict_get(d, k, default):
         return default
 
 
+def select_keys(d, keys):
+    return {k: d[k] for k in keys if k in d}
+
+
 class FlipCache:
-    def __init__(self):
-        self.current_cache = {}
-        self.next_cache = {}
+    def __init__(self, negative_ttl=0, max_size=None):
+        # key -> (generation last used, value), least recently used first
+        self.store = {}
+        # key -> generation in which the fetcher returned nothing for it
+        self.negative = {}
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.generation = 0
         self.hits = 0
         self.misses = 0
 
+    def __len__(self):
+        return len(self.store)
+
     def flip(self):
-        self.current_cache = self.next_cache
-        self.next_cache = {}
+        # keep what was used during the cycle that just ended, drop the rest
+        last_generation = self.generation
+        self.store = {k: e for k, e in self.store.items() if e[0] == last_generation}
+        self.generation += 1
+        if self.negative:
+            oldest = self.generation - self.negative_ttl
+            self.negative = {k: g for k, g in self.negative.items() if g > oldest}
         self.hits = 0
         self.misses = 0
 
     def get_dict(self, keys, fetcher):
-        missing = []
-        result = {}
-        for k in set(keys):
-            if k in self.current_cache:
-                result[k] = self.current_cache[k]
-                self.hits += 1
-            else:
-                missing += [k]
-                self.misses += 1
+        if not isinstance(keys, (set, frozenset)):
+            keys = set(keys)
+        with self.lock:
+            negative = self.negative
+            if negative:
+                keys = {k for k in keys if k not in negative}
+            store = self.store
+            hit_keys = keys & store.keys()
+            missing = list(keys - hit_keys)
+            result = {k: store[k][1] for k in hit_keys}
+            self.hits += len(hit_keys)
+            self.misses += len(missing)
         fetched = fetcher(missing) if missing else {}
         result.update(fetched)
-        self.current_cache.update(fetched)
-        self.next_cache.update(result)
+        with self.lock:
+            generation = self.generation
+            if self.max_size:
+                # re-insert so recently used entries move to the end
+                for k in result:
+                    store.pop(k, None)
+            store.update((k, (generation, v)) for k, v in result.items())
+            self.evict()
+            if self.negative_ttl:
+                for k in missing:
+                    if k not in fetched:
+                        negative[k] = generation
         return result
 
-    def get(self, key, fetcher):
-        if key in self.current_cache:
-            result = self.current_cache[key]
-            self.hits += 1
-        else:
-            self.misses += 1
-            result = fetcher(key)
-        if result:
-            self.current_cache[key] = result
-            self.next_cache[key] = result
+    def evict(self):
+        if self.max_size and len(self.store) > self.max_size:
+            excess = len(self.store) - self.max_size
+            for k in list(islice(self.store, excess)):
+                del self.store[k]
+
+
+class LruCache:
+    def __init__(self, maxsize=2048):
+        self.maxsize = maxsize
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.cache)
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+
+    def store(self, fetched):
+        with self.lock:
+            self.cache.update(fetched)
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+
+    def get_dict(self, keys, fetcher):
+        missing = []
+        result = {}
+        if not isinstance(keys, (set, frozenset)):
+            keys = set(keys)
+        with self.lock:
+            for k in keys:
+                if k in self.cache:
+                    self.cache.move_to_end(k)
+                    result[k] = self.cache[k]
+                else:
+                    missing.append(k)
+            self.hits += len(result)
+            self.misses += len(missing)
+        fetched = fetcher(missing) if missing else {}
+        result.update(fetched)
+        self.store(fetched)
         return result
 
 
@@ -115,19 +201,29 @@ class TaskInfo:
 
 
 class TaskInfoDiscoverer:
-    def __init__(self, fetch_tags=True, cluster_arns=[]):
-        self.ec2_client = boto3.client("ec2")
-        self.ecs_client = boto3.client("ecs")
-        self.task_cache = FlipCache()
-        self.task_definition_cache = FlipCache()
-        self.container_instance_cache = FlipCache()
-        self.ec2_instance_cache = FlipCache()
+    def __init__(self, fetch_tags=True, cluster_arns=[], max_workers=16):
+        config = Config(
+            retries={"max_attempts": 10, "mode": "adaptive"},
+            # both pools can have a request in flight on every worker
+            max_pool_connections=max(50, 2 * max_workers),
+        )
+        self.ec2_client = boto3.client("ec2", config=config)
+        self.ecs_client = boto3.client("ecs", config=config)
+        # separate pools so cluster workers waiting on requests can't starve them
+        self.cluster_executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.request_executor = ThreadPoolExecutor(max_workers=max_workers)
+        # tasks skipped for lacking a network binding are retried two cycles later
+        self.task_cache = FlipCache(negative_ttl=2, max_size=50000)
+        # keyed by revision ARN, which is immutable, so it is never flipped
+        self.task_definition_cache = LruCache(maxsize=2048)
+        self.container_instance_cache = FlipCache(max_size=10000)
+        self.ec2_instance_cache = FlipCache(max_size=10000)
         self.fetch_tags = fetch_tags
         self.cluster_arns = cluster_arns
 
     def flip_caches(self):
         self.task_cache.flip()
-        self.task_definition_cache.flip()
+        self.task_definition_cache.reset_stats()
         self.container_instance_cache.flip()
         self.ec2_instance_cache.flip()
 
@@ -144,96 +240,104 @@ class TaskInfoDiscoverer:
 
             return {**response["taskDefinition"], "tags": response.get("tags", [])}
 
-        def fetcher(fetch_task_arns):
-            tasks = {}
-            result = self.ecs_client.describe_tasks(
+        def fetcher_task_definitions(arns):
+            return dict(
+                zip(arns, self.request_executor.map(fetcher_task_definition, arns))
+            )
+
+        def fetcher_tasks(arns):
+            return self.ecs_client.describe_tasks(
                 cluster=cluster_arn,
-                tasks=fetch_task_arns,
+                tasks=arns,
                 include=[
                     "TAGS",
                 ]
                 if self.fetch_tags
                 else [],
             )
-            if "tasks" in result:
-                for task in result["tasks"]:
-                    no_network_binding = []
-                    for container in task["containers"]:
+
+        def fetcher(fetch_task_arns):
+            tasks = {}
+            described_tasks = []
+            for result in self.request_executor.map(
+                fetcher_tasks, chunk_list(fetch_task_arns, 100)
+            ):
+                described_tasks += dict_get(result, "tasks", [])
+            no_network_bindings = {}
+            for task in described_tasks:
+                no_network_bindings[task["taskArn"]] = {
+                    container["name"]
+                    for container in task["containers"]
+                    if not container.get("networkBindings")
+                    and not container["networkInterfaces"]
+                }
+            task_definitions = self.task_definition_cache.get_dict(
+                {task["taskDefinitionArn"] for task in described_tasks},
+                fetcher_task_definitions,
+            )
+            for task in described_tasks:
+                task_definition = task_definitions[task["taskDefinitionArn"]]
+                # kept on the cached task, so cache hits need no definition lookup
+                task["_task_definition"] = task_definition
+                no_network_binding = no_network_bindings[task["taskArn"]]
+                if no_network_binding:
+                    no_cache = None
+                    is_host_network_mode = task_definition.get("networkMode") == "host"
+                    for container_definition in task_definition["containerDefinitions"]:
+                        environment = get_environment(container_definition)
+                        prometheus = environment.get("PROMETHEUS")
+                        prometheus_port = environment.get("PROMETHEUS_PORT")
+                        port_mappings = container_definition.get("portMappings")
                         if (
-                            "networkBindings" not in container
-                            or len(container["networkBindings"]) == 0
-                        ) and len(container["networkInterfaces"]) == 0:
-                            no_network_binding.append(container["name"])
-                    if no_network_binding:
-                        arn = task["taskDefinitionArn"]
-                        no_cache = None
-                        task_definition = self.task_definition_cache.get(
-                            arn, fetcher_task_definition
-                        )
-                        is_host_network_mode = (
-                            task_definition.get("networkMode") == "host"
-                        )
-                        for container_definition in task_definition[
-                            "containerDefinitions"
-                        ]:
-                            prometheus = get_environment_var(
-                                container_definition["environment"], "PROMETHEUS"
+                            container_definition["name"] in no_network_binding
+                            and prometheus
+                            and not (
+                                is_host_network_mode
+                                and (prometheus_port or port_mappings)
                             )
-                            prometheus_port = get_environment_var(
-                                container_definition["environment"], "PROMETHEUS_PORT"
+                        ):
+                            log(
+                                task["group"]
+                                + ":"
+                                + container_definition["name"]
+                                + " does not have a networkBinding. Skipping for next run."
                             )
-                            port_mappings = container_definition.get("portMappings")
-                            if (
-                                container_definition["name"] in no_network_binding
-                                and prometheus
-                                and not (
-                                    is_host_network_mode
-                                    and (prometheus_port or port_mappings)
-                                )
-                            ):
-                                log(
-                                    task["group"]
-                                    + ":"
-                                    + container_definition["name"]
-                                    + " does not have a networkBinding. Skipping for next run."
-                                )
-                                no_cache = True
-                        if not no_cache:
-                            tasks[task["taskArn"]] = task
-                    else:
+                            no_cache = True
+                    if not no_cache:
                         tasks[task["taskArn"]] = task
+                else:
+                    tasks[task["taskArn"]] = task
             return tasks
 
         return self.task_cache.get_dict(task_arns, fetcher).values()
 
     def create_task_infos(self, cluster_arn, task_arns):
-        return map(lambda t: TaskInfo(t), self.describe_tasks(cluster_arn, task_arns))
-
-    def add_task_definitions(self, task_infos):
-        def fetcher(arn):
-            return self.ecs_client.describe_task_definition(taskDefinition=arn)[
-                "taskDefinition"
-            ]
-
-        for task_info in task_infos:
-            arn = task_info.task["taskDefinitionArn"]
-            task_info.task_definition = self.task_definition_cache.get(arn, fetcher)
+        task_infos = []
+        for t in self.describe_tasks(cluster_arn, task_arns):
+            task_info = TaskInfo(t)
+            task_info.task_definition = t.get("_task_definition")
+            task_infos.append(task_info)
+        return task_infos
 
     def add_container_instances(self, task_infos, cluster_arn):
         def fetcher(arns):
-            arnsChunked = chunk_list(arns, 100)
-            instances = {}
-            for arns in arnsChunked:
-                result = self.ecs_client.describe_container_instances(
-                    cluster=cluster_arn, containerInstances=arns
+            futures = [
+                self.request_executor.submit(
+                    self.ecs_client.describe_container_instances,
+                    cluster=cluster_arn,
+                    containerInstances=chunk,
                 )
-                for i in dict_get(result, "containerInstances", []):
-                    instances[i["containerInstanceArn"]] = i
+                for chunk in chunk_list(arns, 100)
+            ]
+            instances = {}
+            for future in as_completed(futures):
+                for i in dict_get(future.result(), "containerInstances", []):
+                    instances[i["containerInstanceArn"]] = select_keys(
+                        i, ("containerInstanceArn", "ec2InstanceId")
+                    )
             return instances
 
-        containerInstanceArns = list(
-            set(map(lambda t: t.task["containerInstanceArn"], task_infos))
-        )
+        containerInstanceArns = {t.task["containerInstanceArn"] for t in task_infos}
         containerInstances = self.container_instance_cache.get_dict(
             containerInstanceArns, fetcher
         )
@@ -244,18 +348,22 @@ class TaskInfoDiscoverer:
 
     def add_ec2_instances(self, task_infos):
         def fetcher(ids):
-            idsChunked = chunk_list(ids, 100)
+            futures = [
+                self.request_executor.submit(
+                    self.ec2_client.describe_instances, InstanceIds=chunk
+                )
+                for chunk in chunk_list(ids, 100)
+            ]
             instances = {}
-            for ids in idsChunked:
-                result = self.ec2_client.describe_instances(InstanceIds=ids)
-                for r in dict_get(result, "Reservations", []):
+            for future in as_completed(futures):
+                for r in dict_get(future.result(), "Reservations", []):
                     for i in dict_get(r, "Instances", []):
-                        instances[i["InstanceId"]] = i
+                        instances[i["InstanceId"]] = select_keys(
+                            i, ("InstanceId", "PrivateIpAddress")
+                        )
             return instances
 
-        instance_ids = list(
-            set(map(lambda t: t.container_instance["ec2InstanceId"], task_infos))
-        )
+        instance_ids = {t.container_instance["ec2InstanceId"] for t in task_infos}
         instances = self.ec2_instance_cache.get_dict(instance_ids, fetcher)
         for t in task_infos:
             t.ec2_instance = dict_get(
@@ -264,13 +372,14 @@ class TaskInfoDiscoverer:
 
     def get_infos_for_cluster(self, cluster_arn, launch_type):
         tasks_pages = self.ecs_client.get_paginator("list_tasks").paginate(
-            cluster=cluster_arn, launchType=launch_type
+            cluster=cluster_arn,
+            launchType=launch_type,
+            PaginationConfig={"PageSize": 100},
         )
-        task_infos = []
-        for task_arns in tasks_pages:
-            if task_arns["taskArns"]:
-                task_infos += self.create_task_infos(cluster_arn, task_arns["taskArns"])
-        self.add_task_definitions(task_infos)
+        task_arns = []
+        for tasks_page in tasks_pages:
+            task_arns += tasks_page["taskArns"]
+        task_infos = self.create_task_infos(cluster_arn, task_arns)
         if "EC2" in launch_type:
             self.add_container_instances(task_infos, cluster_arn)
         return task_infos
@@ -282,12 +391,12 @@ class TaskInfoDiscoverer:
                 self.task_cache.misses,
                 self.task_definition_cache.hits,
                 self.task_definition_cache.misses,
-                len(self.task_definition_cache.current_cache),
+                len(self.task_definition_cache),
                 self.container_instance_cache.hits,
                 self.container_instance_cache.misses,
                 self.ec2_instance_cache.hits,
                 self.ec2_instance_cache.misses,
-                len(self.ec2_instance_cache.current_cache),
+                len(self.ec2_instance_cache),
             )
         )
 
@@ -295,10 +404,11 @@ class TaskInfoDiscoverer:
         if len(self.cluster_arns) > 0:
             return self.cluster_arns
         cluster_arns = []
-        clusters_pages = self.ecs_client.get_paginator("list_clusters").paginate()
+        clusters_pages = self.ecs_client.get_paginator("list_clusters").paginate(
+            PaginationConfig={"PageSize": 100}
+        )
         for clusters in clusters_pages:
-            for cluster_arn in clusters["clusterArns"]:
-                cluster_arns += [cluster_arn]
+            cluster_arns += clusters["clusterArns"]
 
         return cluster_arns
 
@@ -307,9 +417,20 @@ class TaskInfoDiscoverer:
         task_infos = []
         fargate_task_infos = []
         cluster_arns = self.list_clusters()
-        for cluster_arn in cluster_arns:
-            task_infos += self.get_infos_for_cluster(cluster_arn, "EC2")
-            fargate_task_infos += self.get_infos_for_cluster(cluster_arn, "FARGATE")
+        ec2_futures = [
+            self.cluster_executor.submit(self.get_infos_for_cluster, cluster_arn, "EC2")
+            for cluster_arn in cluster_arns
+        ]
+        fargate_futures = [
+            self.cluster_executor.submit(
+                self.get_infos_for_cluster, cluster_arn, "FARGATE"
+            )
+            for cluster_arn in cluster_arns
+        ]
+        for future in ec2_futures:
+            task_infos += future.result()
+        for future in fargate_futures:
+            fargate_task_infos += future.result()
         self.add_ec2_instances(task_infos)
         task_infos += fargate_task_infos
         self.print_cache_stats()
@@ -334,6 +455,8 @@ class Target:
         self.ip = ip
         self.port = port
         self.metrics_path = metrics_path
+        # shared, immutable (path, interval) pairs
+        self.path_interval = extract_path_interval(metrics_path)
         self.p_instance = p_instance
         self.ecs_task_id = ecs_task_id
         self.ecs_task_name = ecs_task_name
@@ -344,28 +467,58 @@ class Target:
         self.tags = tags
 
 
-def get_environment_var(environment, name):
-    for entry in environment:
-        if entry["name"] == name:
-            return entry["value"]
-    return None
+def fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except OSError:
+        # directories can't be opened or synced on every platform, e.g. Windows
+        pass
+
+
+def dump_json(obj, pretty):
+    if pretty:
+        return json.dumps(obj, indent=4).encode()
+    if orjson is not None:
+        return orjson.dumps(obj)
+    # byte-for-byte what orjson produces, so output doesn't depend on installs
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+def get_environment(container_definition):
+    # cached on the definition, which lives in task_definition_cache
+    environment = container_definition.get("_env_map")
+    if environment is None:
+        environment = container_definition["_env_map"] = {
+            entry["name"]: entry["value"]
+            for entry in container_definition["environment"]
+        }
+    return environment
 
 
+@lru_cache(maxsize=4096)
 def extract_name_from_arn(arn):
-    return arn.split(":")[5].split("/")[-1]
+    # the resource is everything after the fifth colon, minus any ":revision"
+    resource = arn.split(":", 5)[5].partition(":")[0]
+    return resource.rpartition("/")[2]
 
 
+@lru_cache(maxsize=4096)
 def extract_task_version(taskDefinitionArn):
-    return taskDefinitionArn.split(":")[6]
+    return taskDefinitionArn.rpartition(":")[2]
 
 
+@lru_cache(maxsize=1024)
 def extract_path_interval(env_variable):
     path_interval = {}
     if env_variable:
         for lst in env_variable.split(","):
             if ":" in lst:
                 pi = lst.split(":")
-                if re.search("(15s|30s|1m|5m)", pi[0]):
+                if pi[0] in _VALID_INTERVALS:
                     path_interval[pi[1]] = pi[0]
                 else:
                     path_interval[pi[1]] = None
@@ -373,7 +526,8 @@ def extract_path_interval(env_variable):
                 path_interval[lst] = None
     else:
         path_interval["/metrics"] = None
-    return path_interval
+    # cached results are shared, so hand out an immutable copy
+    return tuple(path_interval.items())
 
 
 def task_info_to_targets(task_info):
@@ -385,129 +539,149 @@ def task_info_to_targets(task_info):
     if not task_info.valid():
         return targets
 
+    containers_by_name = {c["name"]: c for c in task["containers"]}
+
     for container_definition in task_definition["containerDefinitions"]:
-        prometheus_enabled = get_environment_var(
-            container_definition["environment"], "PROMETHEUS"
-        )
-        metrics_path = get_environment_var(
-            container_definition["environment"], "PROMETHEUS_ENDPOINT"
-        )
-        nolabels = get_environment_var(
-            container_definition["environment"], "PROMETHEUS_NOLABELS"
-        )
+        environment = get_environment(container_definition)
+        prometheus_enabled = environment.get("PROMETHEUS")
+        metrics_path = environment.get("PROMETHEUS_ENDPOINT")
+        nolabels = environment.get("PROMETHEUS_NOLABELS")
         if nolabels != "true":
             nolabels = None
-        prometheus_port = get_environment_var(
-            container_definition["environment"], "PROMETHEUS_PORT"
-        )
-        prometheus_container_port = get_environment_var(
-            container_definition["environment"], "PROMETHEUS_CONTAINER_PORT"
-        )
-        running_containers = filter(
-            lambda container: container["name"] == container_definition["name"],
-            task["containers"],
-        )
+        prometheus_port = environment.get("PROMETHEUS_PORT")
+        prometheus_container_port = environment.get("PROMETHEUS_CONTAINER_PORT")
 
         if not prometheus_enabled:
             continue
 
+        container = containers_by_name.get(container_definition["name"])
+        if container is None:
+            continue
+
         # get tags from the task definition, and merge/override any tags specifically set on the task
         tags = {
             **{tag["key"]: tag["value"] for tag in task_definition.get("tags", [])},
             **{tag["key"]: tag["value"] for tag in task.get("tags", [])},
         }
 
-        for container in running_containers:
-            ecs_task_name = extract_name_from_arn(task["taskDefinitionArn"])
-            has_host_port_mapping = (
-                "portMappings" in container_definition
-                and len(container_definition["portMappings"]) > 0
-            )
+        ecs_task_name = extract_name_from_arn(task["taskDefinitionArn"])
+        has_host_port_mapping = (
+            "portMappings" in container_definition
+            and len(container_definition["portMappings"]) > 0
+        )
 
-            if prometheus_port:
-                first_port = prometheus_port
-            elif task_definition.get("networkMode") in ("host", "awsvpc"):
-                if has_host_port_mapping:
-                    first_port = str(
-                        container_definition["portMappings"][0]["hostPort"]
-                    )
-                else:
-                    first_port = "80"
-            elif prometheus_container_port:
-                binding_by_container_port = [
-                    c
-                    for c in container["networkBindings"]
-                    if str(c["containerPort"]) == prometheus_container_port
-                ]
-                if binding_by_container_port:
-                    first_port = str(binding_by_container_port[0]["hostPort"])
-                else:
-                    log(
-                        task["group"]
-                        + ":"
-                        + container_definition["name"]
-                        + " does not expose port matching PROMETHEUS_CONTAINER_PORT, omitting"
-                    )
-                    return []
+        if prometheus_port:
+            first_port = prometheus_port
+        elif task_definition.get("networkMode") in ("host", "awsvpc"):
+            if has_host_port_mapping:
+                first_port = str(container_definition["portMappings"][0]["hostPort"])
             else:
-                first_port = str(container["networkBindings"][0]["hostPort"])
-
-            if task_definition.get("networkMode") == "awsvpc":
-                interface_ip = container["networkInterfaces"][0]["privateIpv4Address"]
+                first_port = "80"
+        elif prometheus_container_port:
+            binding_by_container_port = [
+                c
+                for c in container["networkBindings"]
+                if str(c["containerPort"]) == prometheus_container_port
+            ]
+            if binding_by_container_port:
+                first_port = str(binding_by_container_port[0]["hostPort"])
             else:
-                interface_ip = task_info.ec2_instance["PrivateIpAddress"]
+                log(
+                    task["group"]
+                    + ":"
+                    + container_definition["name"]
+                    + " does not expose port matching PROMETHEUS_CONTAINER_PORT, omitting"
+                )
+                continue
+        else:
+            first_port = str(container["networkBindings"][0]["hostPort"])
+
+        if task_definition.get("networkMode") == "awsvpc":
+            interface_ip = container["networkInterfaces"][0]["privateIpv4Address"]
+        else:
+            interface_ip = task_info.ec2_instance["PrivateIpAddress"]
 
-            if nolabels:
-                p_instance = ecs_task_name
-                ecs_task_id = (
-                    ecs_task_version
-                ) = ecs_container_id = ecs_cluster_name = ec2_instance_id = None
+        if nolabels:
+            p_instance = ecs_task_name
+            ecs_task_id = (
+                ecs_task_version
+            ) = ecs_container_id = ecs_cluster_name = ec2_instance_id = None
+        else:
+            p_instance = interface_ip + ":" + first_port
+            ecs_task_id = extract_name_from_arn(task["taskArn"])
+            ecs_task_version = extract_task_version(task["taskDefinitionArn"])
+            ecs_cluster_name = extract_name_from_arn(task["clusterArn"])
+            if "FARGATE" in task_definition.get("requiresCompatibilities", ""):
+                ec2_instance_id = ecs_container_id = None
             else:
-                p_instance = interface_ip + ":" + first_port
-                ecs_task_id = extract_name_from_arn(task["taskArn"])
-                ecs_task_version = extract_task_version(task["taskDefinitionArn"])
-                ecs_cluster_name = extract_name_from_arn(task["clusterArn"])
-                if "FARGATE" in task_definition.get("requiresCompatibilities", ""):
-                    ec2_instance_id = ecs_container_id = None
-                else:
-                    ec2_instance_id = task_info.container_instance["ec2InstanceId"]
-                    ecs_container_id = extract_name_from_arn(container["containerArn"])
-
-            targets += [
-                Target(
-                    ip=interface_ip,
-                    port=first_port,
-                    metrics_path=metrics_path,
-                    p_instance=p_instance,
-                    ecs_task_id=ecs_task_id,
-                    ecs_task_name=ecs_task_name,
-                    ecs_task_version=ecs_task_version,
-                    ecs_container_id=ecs_container_id,
-                    ecs_cluster_name=ecs_cluster_name,
-                    ec2_instance_id=ec2_instance_id,
-                    tags=tags,
-                )
-            ]
+                ec2_instance_id = task_info.container_instance["ec2InstanceId"]
+                ecs_container_id = extract_name_from_arn(container["containerArn"])
+
+        targets.append(
+            Target(
+                ip=interface_ip,
+                port=first_port,
+                metrics_path=metrics_path,
+                p_instance=p_instance,
+                ecs_task_id=ecs_task_id,
+                ecs_task_name=ecs_task_name,
+                ecs_task_version=ecs_task_version,
+                ecs_container_id=ecs_container_id,
+                ecs_cluster_name=ecs_cluster_name,
+                ec2_instance_id=ec2_instance_id,
+                tags=tags,
+            )
+        )
     return targets
 
 
 class Main:
     def __init__(
-        self, directory, interval, default_scrape_interval_prefix, tags_to_labels, cluster_arns
+        self,
+        directory,
+        interval,
+        default_scrape_interval_prefix,
+        tags_to_labels,
+        cluster_arns,
+        pretty_print=False,
+        max_workers=16,
     ):
         self.directory = directory
         self.interval = interval
         self.default_scrape_interval_prefix = default_scrape_interval_prefix
-        self.discoverer = TaskInfoDiscoverer(fetch_tags=len(tags_to_labels) > 0, cluster_arns=cluster_arns)
+        self.discoverer = TaskInfoDiscoverer(
+            fetch_tags=len(tags_to_labels) > 0,
+            cluster_arns=cluster_arns,
+            max_workers=max_workers,
+        )
         self.tags_to_labels = tags_to_labels
+        self.pretty_print = pretty_print
+        self._last_hashes = {}
 
     def write_jobs(self, jobs):
+        updated = False
         for prefix, j in jobs.items():
+            # discovery order varies between cycles, sort so unchanged jobs hash equal
+            j = sorted(j, key=lambda job: json.dumps(job, sort_keys=True))
+            payload = dump_json(j, self.pretty_print)
+            payload_hash = hashlib.blake2b(payload, digest_size=16).digest()
             file_name = self.directory + "/" + prefix + "-tasks.json"
+            if self._last_hashes.get(prefix) == payload_hash and os.path.exists(
+                file_name
+            ):
+                continue
             tmp_file_name = file_name + ".tmp"
-            with open(tmp_file_name, "w") as f:
-                f.write(json.dumps(j, indent=4))
-            os.rename(tmp_file_name, file_name)
+            with open(tmp_file_name, "wb") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file_name, file_name)
+            self._last_hashes[prefix] = payload_hash
+            log("Updated {} with {} jobs".format(file_name, len(j)))
+            updated = True
+        if updated:
+            # persist the renames themselves, not just the file contents
+            fsync_directory(self.directory)
 
     def get_targets(self):
         targets = []
@@ -518,13 +692,10 @@ class Main:
 
     def discover_tasks(self):
         targets = self.get_targets()
-        jobs = defaultdict(list)
-        for i in ["15s", "30s", "1m", "5m"]:
-            jobs[i] = []
+        jobs = {i: [] for i in _INTERVALS + (self.default_scrape_interval_prefix,)}
         log("Targets: " + str(len(targets)))
         for target in targets:
-            path_interval = extract_path_interval(target.metrics_path)
-            for path, interval in path_interval.items():
+            for path, interval in target.path_interval:
                 labels = False
                 if target.ec2_instance_id is None and target.ecs_task_id:
                     labels = {
@@ -554,13 +725,14 @@ class Main:
                     ):
                         # prometheus labels match [a-zA-Z_][a-zA-Z0-9_]*
                         # with leading __ reserved for internal use
-                        tag_name = re.sub(r"[^a-zA-Z0-9_]", "_", tag_name).lstrip("_")
-                        if tag_name != "" and not re.match(r"^[0-9]", tag_name):
+                        tag_name = _INVALID_LABEL_CHARS_RE.sub("_", tag_name)
+                        tag_name = tag_name.lstrip("_")
+                        if tag_name != "" and not _LEADING_DIGIT_RE.match(tag_name):
                             job["labels"]["__meta_ecs_tag_" + tag_name] = tag_value
                 if labels:
                     job["labels"].update(labels)
                 jobs[interval or self.default_scrape_interval_prefix].append(job)
-                log("Discovered Job: " + str(job))
+                logger.debug("Discovered Job: %s", job)
         self.write_jobs(jobs)
 
     def loop(self):
@@ -598,7 +770,26 @@ def main():
         default=[],
         help="The ARNs of the ECS clusters that should be monitored."
     )
+    arg_parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=16,
+        help="The number of clusters, and of AWS requests, to process concurrently.",
+    )
+    arg_parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log every discovered job.",
+    )
+    arg_parser.add_argument(
+        "--pretty-print",
+        action="store_true",
+        help="Indent the service discovery files for readability.",
+    )
     args = arg_parser.parse_args()
+    # the root logger stays at WARNING so botocore's info/debug output is hidden
+    logging.basicConfig(stream=sys.stdout, format="%(message)s")
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
     log(
         f"""
 Starting...
@@ -607,6 +798,9 @@ Refresh interval: "{str(args.interval)}s"
 Default scrape interval prefix: "{args.default_scrape_interval_prefix}"
 Tags to convert to labels: {args.tags_to_labels}
 Clusters to query: {args.cluster_arns}
+Max workers: {args.max_workers}
+Pretty print: {args.pretty_print}
+Verbose: {args.verbose}
         """
     )
     Main(
@@ -614,7 +808,9 @@ Clusters to query: {args.cluster_arns}
         interval=args.interval,
         default_scrape_interval_prefix=args.default_scrape_interval_prefix,
         tags_to_labels=args.tags_to_labels,
-        cluster_arns=args.cluster_arns
+        cluster_arns=args.cluster_arns,
+        pretty_print=args.pretty_print,
+        max_workers=args.max_workers,
     ).loop()
 
 